@@ -0,0 +1,521 @@
+import io
+import re
+import traceback
+import unittest
+from collections import defaultdict
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+from unittest import mock
+
+import torch
+
+from ..tools import eg_replay
+from ..tools.eg_replay import (
+    COPY_OPS_NON_BLOCKING_INDEX,
+    ExgrReplayManager,
+    group_row_numel,
+    group_rows,
+    INPUT_CONSTANT,
+    INPUT_TENSOR,
+    INPUT_TENSOR_LIST,
+)
+from ..tools.eg_replay_utils import (
+    parse_tensor_dtype,
+    tensor_dtype_bytes,
+    tensor_dtype_rng,
+    tensor_dtype_rng_str,
+    TORCH_DTYPE_ELEMENT_BYTES,
+    TORCH_DTYPES_BYTES,
+    TORCH_DTYPES_RNG,
+    TORCH_DTYPES_RNG_str,
+)
+
+
+def make_node(
+    node_id, name, inputs, input_types, out_sids=(), output_types=(), in_sids=()
+):
+    return SimpleNamespace(
+        id=node_id,
+        name=name,
+        inputs=inputs,
+        input_types=input_types,
+        output_types=list(output_types),
+        _in_sids=list(in_sids),
+        _out_sids=list(out_sids),
+        _is_fbgemm_forward=False,
+        _is_fbgemm_forward_unweighted=False,
+    )
+
+
+def make_manager(nodes, funcs, tensors_mapping, num_tensors):
+    # Only the state read by the code generation, without loading a graph.
+    replay_manager = ExgrReplayManager.__new__(ExgrReplayManager)
+    replay_manager.sorted_nodes = nodes
+    replay_manager.run_nodes = list(nodes)
+    replay_manager.funcs = funcs
+    replay_manager.tensors_mapping = tensors_mapping
+    replay_manager.tensor_registry = [None] * (num_tensors + 1)
+    replay_manager.tensor_registry_permanent = {}
+    replay_manager.dependency_permanent = {
+        t_id for (_, t_id, is_input) in tensors_mapping if not is_input
+    }
+    replay_manager.unchangeable_intermediate_tensors = set()
+    replay_manager.instantiate = set()
+    replay_manager.tensor_with_device = False
+    replay_manager.generator = False
+    replay_manager.compile = False
+    replay_manager.profile_memory = False
+    replay_manager.async_h2d_copy = False
+    replay_manager._host_written_slots = None
+    replay_manager.cuda = "cuda:0"
+    return replay_manager
+
+
+class TestGenerateRunOps(unittest.TestCase):
+    def test_constants_round_trip(self):
+        in_t_id = (1, 2, 0, 4, 4, 0)
+        out_t_id = (3, 4, 0, 4, 4, 0)
+        constants = ['a"b\\c', [1, float("inf"), None, "d'e"], "-inf", "<None>", 0.5]
+        node = make_node(
+            10,
+            "aten::fake",
+            [list(in_t_id)] + constants,
+            ["Tensor(float)", "str", "GenericList[Int]", "float", "None", "float"],
+            out_sids=[out_t_id],
+            output_types=["Tensor(float)"],
+        )
+        calls = []
+
+        def func(*args):
+            calls.append(args)
+            return "out"
+
+        replay_manager = make_manager(
+            [node],
+            {node.id: (func, 1)},
+            {(node.id, in_t_id, True): 1, (node.id, out_t_id, False): 2},
+            2,
+        )
+        replay_manager.tensor_registry[1] = "in"
+
+        run_ops_str = replay_manager.generate_run_ops_str()
+        self.assertIn("f10=funcs[10][0],", run_ops_str)
+        self.assertIn("# node id: 10", run_ops_str)
+
+        replay_manager.build_replay_func()
+        replay_manager.replay_func()
+        self.assertEqual(
+            calls,
+            [
+                (
+                    "in",
+                    'a"b\\c',
+                    [1, float("inf"), None, "d'e"],
+                    float("-inf"),
+                    None,
+                    0.5,
+                )
+            ],
+        )
+        self.assertEqual(replay_manager.tensor_registry[2], "out")
+
+    def test_empty_run_ops(self):
+        replay_manager = make_manager([], {}, {}, 0)
+        replay_manager.build_replay_func()
+        self.assertIsNone(replay_manager.replay_func())
+
+    def test_traceback_names_node(self):
+        in_t_id = (1, 2, 0, 4, 4, 0)
+        node = make_node(11, "aten::fake", [list(in_t_id)], ["Tensor(float)"])
+
+        def func(*args):
+            raise RuntimeError("fake failure")
+
+        replay_manager = make_manager(
+            [node], {node.id: (func, 0)}, {(node.id, in_t_id, True): 1}, 1
+        )
+        replay_manager.build_replay_func()
+        # assertRaises drops the traceback of the exception, format it here.
+        tb_str = ""
+        try:
+            replay_manager.replay_func()
+        except RuntimeError:
+            tb_str = traceback.format_exc()
+        self.assertIn("# node id: 11, name: aten::fake", tb_str)
+
+    def test_failed_node_dropped(self):
+        nodes = [make_node(20, "aten::ok", [], []), make_node(21, "aten::bad", [], [])]
+        calls = []
+        funcs = {
+            node.id: (lambda node_id=node.id: calls.append(node_id), 0)
+            for node in nodes
+        }
+        replay_manager = make_manager(nodes, funcs, {}, 0)
+        replay_manager.numWarmupIters = 2
+        replay_manager.failed_nodes = set()
+        replay_manager.build_replay_func()
+
+        # Stands for the checked run_op, with node 21 failing.
+        def run_op(node, iter):
+            if node.id == 21:
+                replay_manager.failed_nodes.add(node.id)
+                replay_manager.run_nodes = [nodes[0]]
+
+        replay_manager.run_op = run_op
+        replay_manager.replay_iteration(0)
+        replay_manager.replay_iteration(1)
+        self.assertEqual(calls, [20])
+        self.assertNotIn("f21", replay_manager.generate_run_ops_str())
+
+
+class TreeNode:
+    # Graph node with the fields read by the traversals, hashable as the graph nodes are.
+    def __init__(self, node_id, name, children=(), t_ids=()):
+        self.id = node_id
+        self.name = name
+        self.children = list(children)
+        self._in_tensors = [("Tensor(float)", t_id, [1]) for t_id in t_ids]
+        self._out_tensors = []
+
+
+class TestTraversal(unittest.TestCase):
+    def test_detect_tensor_device(self):
+        t_id = (1, 1, 0, 1, 4)
+        for first_t_id, tensor_with_device in [(t_id + (0,), True), (t_id, False)]:
+            other_t_id = t_id if tensor_with_device else t_id + (0,)
+            # The first tensor in pre-order is under the first child, before its sibling.
+            root = TreeNode(
+                0,
+                "root",
+                [
+                    TreeNode(1, "a", [TreeNode(3, "b", t_ids=[first_t_id])]),
+                    TreeNode(2, "c", t_ids=[other_t_id]),
+                ],
+            )
+            replay_manager = make_manager([], {}, {}, 0)
+            replay_manager.tensor_with_device = True
+            replay_manager.detect_tensor_device(root)
+            self.assertEqual(replay_manager.tensor_with_device, tensor_with_device)
+
+    def test_extract_subgraph(self):
+        root = TreeNode(
+            0,
+            "root",
+            [
+                TreeNode(
+                    1,
+                    "module",
+                    [TreeNode(5, "aten::mul"), TreeNode(3, "aten::add")],
+                ),
+                TreeNode(2, "aten::relu"),
+                TreeNode(6, "fb::foo", [TreeNode(7, "aten::neg")]),
+            ],
+        )
+        replay_manager = make_manager([], {}, {}, 0)
+        replay_manager.actual_skip_nodes = []
+        replay_manager.actual_skip_nodes_cnt = 0
+        replay_manager.sorted_nodes_set = set()
+        replay_manager.top_tensors = {}
+        replay_manager.dependency_permanent = set()
+        replay_manager._skip_re = re.compile("fb::")
+        replay_manager._fbgemm_flags = lambda node: None
+        visited = []
+
+        def build_func(node):
+            visited.append(node.id)
+            return None, 0
+
+        replay_manager.build_func = build_func
+        with mock.patch.object(
+            eg_replay, "is_qualified", lambda node: node.name.startswith("aten::")
+        ), mock.patch.object(eg_replay, "skip_op", lambda node: False):
+            with redirect_stdout(io.StringIO()):
+                replay_manager.extract_subgraph(root)
+
+        # Visited in pre-order, replayed in node id order, the skipped subtree is not visited.
+        self.assertEqual(visited, [5, 3, 2])
+        self.assertEqual([node.id for node in replay_manager.sorted_nodes], [2, 3, 5])
+        self.assertEqual(replay_manager.actual_skip_nodes, ["fb::foo"])
+        self.assertEqual(replay_manager.actual_skip_nodes_cnt, 1)
+
+
+class TestAnalyzeTensors(unittest.TestCase):
+    def make_tensor_node(self, node_id, ins, outs):
+        # ins/outs: [(tensor id, shape)], the node tensors as parsed by _ins/_outs.
+        node = make_node(
+            node_id,
+            "aten::fake",
+            [],
+            [],
+            out_sids=[t_id for t_id, _ in outs],
+            in_sids=[t_id for t_id, _ in ins],
+        )
+        node._in_tensors = [("Tensor(float)", t_id, shape) for t_id, shape in ins]
+        node._out_tensors = [("Tensor(float)", t_id, shape) for t_id, shape in outs]
+        node._in_devices = [-1] * len(ins)
+        node._out_devices = [-1] * len(outs)
+        return node
+
+    def test_replay_ids(self):
+        t = (1, 1, 0, 6, 4)
+        u = (2, 2, 0, 4, 4)
+        nodes = [
+            self.make_tensor_node(1, [(u, [4])], [(t, [2, 3])]),
+            self.make_tensor_node(2, [(t, [2, 3]), (u, [4])], []),
+            self.make_tensor_node(3, [(t, [6])], []),
+        ]
+        replay_manager = make_manager(nodes, {}, {}, 0)
+        replay_manager.dependency_permanent = {t, u}
+        replay_manager.tensor_shape_to_rid = defaultdict(dict)
+        replay_manager.replay_unique_tensor_num = 0
+        replay_manager.replay_tensors_shapes = {}
+        replay_manager.original_unique_tensors = set()
+        replay_manager.analyze_tensors()
+
+        mapping = replay_manager.tensors_mapping
+        # One replay tensor per (tensor id, shape).
+        self.assertEqual(replay_manager.replay_unique_tensor_num, 3)
+        self.assertEqual(mapping[(1, u, True)], mapping[(2, u, True)])
+        self.assertEqual(mapping[(1, t, False)], mapping[(2, t, True)])
+        self.assertEqual(replay_manager.original_unique_tensors, {t, u})
+        # t is produced by node 1 with shape [2, 3] only, its [6] view is instantiated.
+        t_6 = mapping[(3, t, True)]
+        self.assertEqual(replay_manager.tensor_shape_to_rid[t][(6,)], t_6)
+        self.assertEqual(replay_manager.replay_tensors_shapes[t_6], [6])
+        self.assertEqual(replay_manager.instantiate, {mapping[(1, u, True)], t_6})
+
+
+class TestRegistrySlots(unittest.TestCase):
+    T_A, T_B, T_C = (1, 1, 0, 4, 4), (2, 2, 0, 4, 4), (3, 3, 0, 4, 4)
+
+    def test_tensor_slots(self):
+        node = make_node(
+            10,
+            "aten::cat",
+            [list(self.T_A), [list(self.T_B), list(self.T_C)], 0],
+            ["Tensor(float)", "GenericList[Tensor(float),Tensor(float)]", "Int"],
+        )
+        replay_manager = make_manager(
+            [node],
+            {},
+            {
+                (node.id, self.T_A, True): 1,
+                (node.id, self.T_B, True): 2,
+                (node.id, self.T_C, True): 3,
+            },
+            3,
+        )
+        replay_manager.tensor_registry[1:] = ["a", "b", "c"]
+        replay_manager.build_registry_slots()
+
+        self.assertEqual(
+            node._input_kinds, (INPUT_TENSOR, INPUT_TENSOR_LIST, INPUT_CONSTANT)
+        )
+        self.assertEqual(node._input_slots, (1, (2, 3), 0))
+        self.assertEqual(node._lookup_cnt, 3)
+        self.assertEqual(replay_manager.get_inputs_fast(node), ["a", ["b", "c"], 0])
+
+    def test_constant_slots(self):
+        # Constant inputs are resolved to the values passed to the op.
+        node = make_node(
+            11,
+            "aten::fake",
+            ["<None>", "inf", "-inf", "cuda:1", "cpu", 0.5, "<Generator>"],
+            ["None", "float", "float", "Device", "Device", "float", "Generator"],
+        )
+        replay_manager = make_manager([node], {}, {}, 0)
+        replay_manager.build_registry_slots()
+
+        self.assertEqual(node._input_kinds, (INPUT_CONSTANT,) * 7)
+        self.assertEqual(node._lookup_cnt, 0)
+        self.assertEqual(
+            replay_manager.get_inputs_fast(node),
+            [None, float("inf"), float("-inf"), "cuda:0", "cpu", 0.5, None],
+        )
+
+    def test_output_slots(self):
+        t_d, t_e = (4, 4, 0, 4, 4), (5, 5, 0, 4, 4)
+        t_f, t_g = (6, 6, 0, 4, 4), (7, 7, 0, 4, 4)
+        node = make_node(12, "aten::fake", [], [], out_sids=[t_d, t_e, t_f, t_g])
+        replay_manager = make_manager(
+            [node],
+            {},
+            {
+                (node.id, t_d, False): 1,
+                (node.id, t_e, False): 2,
+                (node.id, t_f, False): 3,
+                (node.id, t_g, False): 4,
+            },
+            4,
+        )
+        # t_e is not used by any other node, t_f must keep its allocated value, and t_g is
+        # unchangeable: only t_d is written back to the registry.
+        replay_manager.dependency_permanent = {t_d, t_f, t_g}
+        replay_manager.instantiate = {3}
+        replay_manager.unchangeable_intermediate_tensors = {4}
+        replay_manager.build_registry_slots()
+
+        self.assertEqual(node._output_slots, (1, None, None, None))
+
+
+class TestAsyncCopy(unittest.TestCase):
+    # Inputs of each overload of the copy ops, with the non_blocking argument.
+    COPY_OVERLOADS = [
+        ("aten::to", ["Tensor(float)", "Int", "Bool", "Bool", "None"], 2),
+        ("aten::to", ["Tensor(float)", "Device", "Int", "Bool", "Bool", "None"], 3),
+        (
+            "aten::to",
+            ["Tensor(float)", "Int", "None", "Device", "None", "Bool", "Bool", "None"],
+            5,
+        ),
+        (
+            "aten::_to_copy",
+            ["Tensor(float)", "Int", "None", "Device", "None", "Bool", "None"],
+            5,
+        ),
+        ("aten::copy_", ["Tensor(float)", "Tensor(float)", "Bool"], 2),
+    ]
+
+    def make_copy_manager(self, name, input_types, other_nodes=()):
+        src_t_id = (1, 2, 0, 4, 4, 0)
+        src_idx = 1 if name == "aten::copy_" else 0
+        inputs = []
+        for idx, input_type in enumerate(input_types):
+            if idx == src_idx:
+                inputs.append(list(src_t_id))
+            else:
+                inputs.append(False if input_type == "Bool" else None)
+        node = make_node(10, name, inputs, input_types)
+        replay_manager = make_manager(
+            [node, *other_nodes],
+            {},
+            {
+                (node.id, src_t_id, True): 1,
+                **{(n.id, src_t_id, False): 1 for n in other_nodes},
+            },
+            1,
+        )
+        replay_manager.tensor_registry_permanent[1] = "pinned"
+        replay_manager.cpu_tensor = {1}
+        replay_manager.async_h2d_copy = True
+        return replay_manager, node
+
+    def test_overloads(self):
+        for name, input_types, non_blocking_idx in self.COPY_OVERLOADS:
+            self.assertEqual(
+                COPY_OPS_NON_BLOCKING_INDEX[name][len(input_types)], non_blocking_idx
+            )
+            replay_manager, node = self.make_copy_manager(name, input_types)
+            self.assertEqual(
+                replay_manager.async_copy_input_index(node), non_blocking_idx
+            )
+
+    def test_opt_in(self):
+        name, input_types, _ = self.COPY_OVERLOADS[0]
+        replay_manager, node = self.make_copy_manager(name, input_types)
+        replay_manager.async_h2d_copy = False
+        self.assertIsNone(replay_manager.async_copy_input_index(node))
+
+    def test_source_written_by_op(self):
+        name, input_types, _ = self.COPY_OVERLOADS[0]
+        writer = make_node(5, "aten::fill_", [], [], out_sids=[(1, 2, 0, 4, 4, 0)])
+        replay_manager, node = self.make_copy_manager(name, input_types, [writer])
+        self.assertIsNone(replay_manager.async_copy_input_index(node))
+
+    def test_device_source(self):
+        name, input_types, _ = self.COPY_OVERLOADS[0]
+        replay_manager, node = self.make_copy_manager(name, input_types)
+        replay_manager.cpu_tensor = set()
+        self.assertIsNone(replay_manager.async_copy_input_index(node))
+
+
+class TestGroupRows(unittest.TestCase):
+    def test_row_numel(self):
+        # Aligned rows are not padded.
+        self.assertEqual(group_row_numel((4, 2), torch.float32), 8)
+        # 16-byte alignment for the small rows, 128-byte for the large ones.
+        self.assertEqual(group_row_numel((3,), torch.float32), 4)
+        self.assertEqual(group_row_numel((5,), torch.half), 8)
+        self.assertEqual(group_row_numel((1025,), torch.float32), 1056)
+        self.assertEqual(group_row_numel((1024,), torch.float32), 1024)
+
+    def test_rows(self):
+        shape = (3, 5)
+        tensors = torch.zeros((2, group_row_numel(shape, torch.int8)), dtype=torch.int8)
+        rows = group_rows(tensors, shape)
+        self.assertEqual(rows.shape, (2, 3, 5))
+        rows.fill_(1)
+        # The padding is left untouched.
+        self.assertEqual(int(tensors.sum()), 2 * 15)
+        self.assertEqual(rows[1].data_ptr() - rows[0].data_ptr(), 16)
+
+
+class TestAnalyzeOps(unittest.TestCase):
+    def test_classification(self):
+        # Reference classification, one substring check per category in precedence order.
+        def classify(op):
+            if "fused" in op:
+                return "fused"
+            elif "aten::record_stream" in op or "aten::set_" in op:
+                return "aten unsupported"
+            elif "aten::" in op:
+                return "aten"
+            elif "fb::" in op or "fbgemm::" in op:
+                return "custom"
+            return None
+
+        ops = [
+            "fused_op",
+            "aten::set_fused",
+            "aten::record_stream",
+            "aten::set_",
+            "aten::add",
+            "fb::x_fused",
+            "fb::aten::add",
+            "fbgemm::foo",
+            "fb::bar",
+            "other::baz",
+        ]
+        replay_manager = ExgrReplayManager.__new__(ExgrReplayManager)
+        replay_manager.actual_skip_nodes = ops
+        out = io.StringIO()
+        with redirect_stdout(out):
+            replay_manager.analyze_ops()
+        lines = out.getvalue().splitlines()
+
+        classes = [classify(op) for op in ops]
+        self.assertEqual(lines[0], "other::baz")
+        for category in ["fused", "aten unsupported", "aten", "custom"]:
+            self.assertIn(f"{category} cnt:  {classes.count(category)}", lines)
+
+
+class TestTensorDtype(unittest.TestCase):
+    def test_parse_tensor_dtype(self):
+        self.assertEqual(parse_tensor_dtype("Tensor(float)"), "float")
+        self.assertEqual(parse_tensor_dtype("Tensor(long int)"), "long int")
+        self.assertEqual(parse_tensor_dtype("Tensor(c10::Half)"), "c10::Half")
+        self.assertEqual(parse_tensor_dtype("float"), "float")
+
+    def test_dtype_tables(self):
+        for dtype in TORCH_DTYPES_RNG:
+            data_type = f"Tensor({dtype})"
+            self.assertEqual(tensor_dtype_rng(data_type), TORCH_DTYPES_RNG[dtype])
+            self.assertEqual(
+                tensor_dtype_rng_str(data_type), TORCH_DTYPES_RNG_str[dtype]
+            )
+            self.assertEqual(tensor_dtype_bytes(data_type), TORCH_DTYPES_BYTES[dtype])
+
+    def test_element_bytes(self):
+        for dtype, _ in TORCH_DTYPES_RNG.values():
+            self.assertEqual(
+                TORCH_DTYPE_ELEMENT_BYTES[dtype],
+                torch.empty((), dtype=dtype).element_size(),
+            )
+
+    def test_unknown_dtype(self):
+        with self.assertRaises(KeyError):
+            tensor_dtype_rng("Tensor(nullptr (uninitialized))")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,13 @@
 import argparse
 import gc
+import inspect
 import json
+import linecache
+import re
 import time
 from collections import defaultdict
 from datetime import datetime
-from functools import reduce
-
-import numpy as np
+from math import isfinite, prod
 
 import torch
 
@@ -15,6 +16,7 @@ from param_bench.train.compute.python.lib.init_helper import load_modules
 from param_bench.train.compute.python.tools.eg_replay_utils import (
     build_fbgemm_func,
     build_torchscript_func,
+    CUDA_GRAPH_UNSAFE_OPS,
     fbgemm_input_args_indices,
     generate_fbgemm_tensors,
     generate_prefix,
@@ -30,9 +32,11 @@ from param_bench.train.compute.python.tools.eg_replay_utils import (
     is_tensor,
     is_tensor_list,
     skip_op,
-    TORCH_DTYPES_BYTES,
-    TORCH_DTYPES_RNG,
-    TORCH_DTYPES_RNG_str,
+    STORAGE_SENSITIVE_OPS,
+    tensor_dtype_bytes,
+    tensor_dtype_rng,
+    tensor_dtype_rng_str,
+    TORCH_DTYPE_ELEMENT_BYTES,
 )
 
 from param_bench.train.compute.python.tools.execution_graph import (
@@ -46,6 +50,79 @@ from param_bench.train.compute.python.tools.utility import (
 from param_bench.train.compute.python.workloads import pytorch as workloads_pytorch
 from torch.profiler import ExecutionGraphObserver
 
+# Kinds of the inputs of a node, see ExgrReplayManager.build_registry_slots. The slot of a
+# constant input holds its value.
+INPUT_CONSTANT, INPUT_TENSOR, INPUT_TENSOR_LIST = 0, 1, 2
+# Kinds of the outputs of a node, see ExgrReplayManager.run_op.
+OUTPUT_OTHER, OUTPUT_TENSOR, OUTPUT_TENSOR_LIST = 0, 1, 2
+
+
+# Index of the non_blocking argument of the copy ops, by overload (number of inputs).
+COPY_OPS_NON_BLOCKING_INDEX = {
+    "aten::to": {5: 2, 6: 3, 8: 5},
+    "aten::_to_copy": {7: 5},
+    "aten::copy_": {3: 2},
+}
+
+
+# Source of the generated run_ops when memory is profiled, see ExgrReplayManager.build_replay_func.
+RUN_OPS_FILE = "/tmp/replay_run_ops.py"
+
+
+# Alignment (in bytes) of the tensors allocated in groups, which the vectorized loads and stores
+# of the kernels need. Rows of at least GROUP_TENSOR_LINE_MIN_BYTES are aligned on a cache line,
+# the padding is negligible for them.
+GROUP_TENSOR_ALIGNMENT = 16
+GROUP_TENSOR_LINE_ALIGNMENT = 128
+GROUP_TENSOR_LINE_MIN_BYTES = 4096
+
+
+def group_row_numel(shape, dtype):
+    # Number of elements of one row of a group of tensors with this shape. Only the rows whose
+    # size is not a multiple of the alignment are padded.
+    elem_bytes = TORCH_DTYPE_ELEMENT_BYTES[dtype]
+    row_bytes = prod(shape) * elem_bytes
+    alignment = (
+        GROUP_TENSOR_LINE_ALIGNMENT
+        if row_bytes >= GROUP_TENSOR_LINE_MIN_BYTES
+        else GROUP_TENSOR_ALIGNMENT
+    )
+    row_bytes = -(-row_bytes // alignment) * alignment
+    return row_bytes // elem_bytes
+
+
+def group_rows(tensors, shape):
+    # View of the rows of a group, without their padding, shaped as the grouped tensors.
+    return tensors[:, : prod(shape)].view((len(tensors),) + shape)
+
+
+def constant_str(value):
+    # Source of a constant input in the generated code, evaluating to the value itself.
+    if isinstance(value, float) and not isfinite(value):
+        return f'float("{value}")'
+    if isinstance(value, list):
+        return "[" + ", ".join(constant_str(x) for x in value) + "]"
+    return repr(value)
+
+
+def fill_offsets(offsets, offsets_tensor_shape, nnz):
+    # offsets[i] = i * nnz, truncated to the offsets dtype.
+    offsets.copy_(
+        torch.arange(
+            offsets_tensor_shape, dtype=torch.float64, device=offsets.device
+        ).mul_(nnz)
+    )
+
+
+# Workaround to eliminate the "strides() called on undefined Tensor" error.
+def fix_convolution_backward_inputs(inputs):
+    inputs[-1] = [True, True, True]
+
+
+# Workaround to handle tensor with same id but different data types (ads_cmf10x_single_iter_512_newest_eg.json).
+def fix_double_source_inputs(inputs):
+    inputs[3] = inputs[3].to(torch.float64)
+
 
 class ExgrReplayManager:
     def __init__(self, exgr, args):
@@ -63,17 +140,54 @@ class ExgrReplayManager:
         self.exgr_input = exgr
         self.dump = args.dump
         self.dump_path = args.dump_path
+        self.disable_jit_profiling = args.disable_jit_profiling
+        self.compile = args.compile
+        self.cuda_graph = args.cuda_graph
+        self.reset_inputs = args.reset_inputs
+        self.async_h2d_copy = args.async_h2d_copy
+
+        # The compiled run_ops manages its own CUDA graphs (reduce-overhead mode), capturing it
+        # again in a manual graph nests the captures. The per op bookkeeping of debug runs is done
+        # by run_op, which is not called when the captured graph is replayed.
+        if self.cuda_graph and (self.compile or (self.debug and not self.generator)):
+            print(
+                "--cuda-graph is ignored with --compile or --debug, replay without it."
+            )
+            self.cuda_graph = False
+
+        if self.disable_jit_profiling:
+            # Replay only: the funcs built from the graph are fed with varying shapes, under the
+            # profiling executor that triggers re-profiling and recompilation, use the legacy
+            # executor instead.
+            torch._C._jit_set_profiling_executor(False)
+            torch._C._jit_set_profiling_mode(False)
 
         # Permanent registry of the tensors that need to be initialized.
         self.tensor_registry_permanent = {}
-        # Registry of all input tensors. TODO: change to set
-        self.dependency_permanent = defaultdict(int)
-        # Runtime registry of all tensors.
-        self.tensor_registry = {}
+        # Registry of all input tensors.
+        self.dependency_permanent = set()
+        # Runtime registry of all tensors, indexed by replay tensor id.
+        self.tensor_registry = []
+        # Tensors allocated on their own instead of in a group (inputs of STORAGE_SENSITIVE_OPS)
+        # that are moved to the device, materialized again from their host tensor on reset:
+        # [(pinned host tensor, replay tensor id)].
+        self._own_masters = []
+        # (dtype, device) -> (device tensors, pinned host tensors), copied in batch on reset.
+        self._device_masters = {}
         # Nodes/Ops to replay after preprocessing.
         self.sorted_nodes = []
+        # Same nodes as sorted_nodes, for fast membership check.
+        self.sorted_nodes_set = set()
+        # Nodes to run in the eager replay, sorted_nodes without the nodes that failed in warmup.
+        self.run_nodes = []
+        # Ids of the nodes that failed in warmup.
+        self.failed_nodes = set()
+        # Registry slots written by the replayed ops, see host_written_slots.
+        self._host_written_slots = None
         # Reconstructed function registry for each node/op.
         self.funcs = {}
+        # Straight-line function replaying all the nodes on the tensor registry, see build_replay_func.
+        self.replay_func = None
         # Mark some intermediate tensors (output of operators) as unchangeable.
         self.unchangeable_intermediate_tensors = set()
         # Unique tensors in execution graph identified by (tensor_id, storage_id, offset, num_elem, elem_bytes).
@@ -87,9 +201,10 @@ class ExgrReplayManager:
         self.tensors_mapping = {}
         # Dict that stores the shape of each unique tensor in replay.
         self.replay_tensors_shapes = {}
-        # Dict that stores the shapes of a tensor, for the convenience of quickly determining whether
-        # to create a unique tensor in replay if the id is same but shape is different.
-        self.tensor_shapes = defaultdict(set)
+        # Dict that maps the shapes of a tensor to their unique tensor_id in replay, for the convenience
+        # of quickly determining whether to create a unique tensor in replay if the id is same but shape
+        # is different.
+        self.tensor_shape_to_rid = defaultdict(dict)
         # Mark those tensors that occur first as an input in the original eg as needing to be instantiated in replay
         # at the very beginning.
         self.instantiate = set()
@@ -106,12 +221,8 @@ class ExgrReplayManager:
             "All2All_Pooled_Wait",
             "adagrad",
         ]
-
-        if self.profile_memory:
-            self.current_allocated_mem = 0
-            self.current_reserved_mem = 0
-            self.op_allocated_mem = {}
-            self.op_reserved_mem = {}
+        # Match any of the names above in a single pass.
+        self._skip_re = re.compile("|".join(re.escape(x) for x in self.skip_node_names))
 
         if self.cuda_id == -1:
             self.cuda = "cuda"
@@ -119,6 +230,11 @@ class ExgrReplayManager:
             self.cuda = f"cuda:{self.cuda_id}"
 
         self.device = torch.device(self.cuda)
+        # Side stream for the initial H2D copies, issued as each group is materialized, so the
+        # copies in flight overlap with the host side preparation of the next groups.
+        self._alloc_stream = torch.cuda.Stream(self.device)
+        # Stream all the replay iterations are issued on, also the CUDA graph capture stream.
+        self._replay_stream = torch.cuda.Stream(self.device)
 
         self.fbgemm_backward_ops = []
 
@@ -142,135 +258,170 @@ class ExgrReplayManager:
         # Unrecognized nodes that are neither operators nor predefined label nodes.
         self.exceptional_nodes = set()
 
-        # Debug use for execution time breakdown.
+        # Debug use, the per op times are collected by the profiler (--profile-replay).
         self.lookup_cnt = 0
-        self.input_total_time = 0
-        self.output_total_time = 0
-        self.exec_time = []
-        self.setup_time = []
 
     def detect_tensor_device(self, root):
         # Automatically detect whether the captured tensor information includes device.
         # Just a util to accommodate old and new versions eg and should be removed later.
-        def _traverse(root):
-            for child in root.children:
-                for _, t_id, _ in get_input_tensors(child):
-                    if len(list(t_id)) == 5:
-                        self.tensor_with_device = False
-                    return
-                for _, t_id, _ in get_output_tensors(child):
-                    if len(list(t_id)) == 5:
-                        self.tensor_with_device = False
-                    return
-                _traverse(child)
-
-        _traverse(root)
-
-    def reset_registry(self):
+        # Check the first tensor met in a pre-order traversal of the graph.
+        stack = list(reversed(root.children))
+        while stack:
+            node = stack.pop()
+            tensors = self._ins(node) or self._outs(node)
+            if tensors:
+                _, t_id, _ = tensors[0]
+                if len(t_id) == 5:
+                    self.tensor_with_device = False
+                return
+            stack.extend(reversed(node.children))
+
+    def _ins(self, node):
+        # Input/output tensors of a node, parsed once and cached on the node.
+        if not hasattr(node, "_in_tensors"):
+            node._in_tensors = list(get_input_tensors(node))
+        return node._in_tensors
+
+    def _outs(self, node):
+        if not hasattr(node, "_out_tensors"):
+            node._out_tensors = list(get_output_tensors(node))
+        return node._out_tensors
+
+    def _short_ids(self, node):
+        # Cache the identifiers (tensor_id, storage_id, offset, num_elem, elem_bytes) of the node
+        # input/output tensors on the node, along with their devices, so they are only built once.
+        if hasattr(node, "_in_sids"):
+            return
+        in_ids = [t_id for _, t_id, _ in self._ins(node)]
+        out_ids = [t_id for _, t_id, _ in self._outs(node)]
         if self.tensor_with_device:
-            self.tensor_registry = {
-                k: (
-                    None
-                    if v is None
-                    else (v if self.tensor_device[k] == "cpu" else v.cuda(self.device))
-                )
-                for k, v in self.tensor_registry_permanent.items()
-            }
+            node._in_sids = [tuple(t_id[:5]) for t_id in in_ids]
+            node._out_sids = [tuple(t_id[:5]) for t_id in out_ids]
+            node._in_devices = [t_id[5] for t_id in in_ids]
+            node._out_devices = [t_id[5] for t_id in out_ids]
         else:
-            self.tensor_registry = {
-                k: (
-                    None
-                    if v is None
-                    else (v if k in self.cpu_tensor else v.cuda(self.device))
-                )
-                for k, v in self.tensor_registry_permanent.items()
-            }
-        gc.collect()
-        torch.cuda.empty_cache()
+            node._in_sids = [tuple(t_id) for t_id in in_ids]
+            node._out_sids = [tuple(t_id) for t_id in out_ids]
+            node._in_devices = [-1] * len(in_ids)
+            node._out_devices = [-1] * len(out_ids)
+
+    def _fbgemm_flags(self, node):
+        # Cache the fbgemm checks of the node, they only depend on the node name and inputs.
+        node._is_fbgemm_forward = is_fbgemm_forward(node)
+        node._is_fbgemm_forward_unweighted = is_fbgemm_forward_unweighted(node)
+        node._is_fbgemm_backward = is_fbgemm_backward(node)
+        node._fbgemm_idx_list = (
+            fbgemm_input_args_indices(node) if node._is_fbgemm_forward else None
+        )
+
+    def is_cpu_tensor(self, replay_t_id):
+        if self.tensor_with_device:
+            return self.tensor_device[replay_t_id] == "cpu"
+        return replay_t_id in self.cpu_tensor
+
+    def issue_device_master(self, tensors, replay_t_ids, shape):
+        # Pre-allocate the device copy of a materialized group and issue its H2D copy right away,
+        # so the copy is in flight while the host materializes the next groups. The groups that
+        # are moved to the device are kept by (dtype, device), so that reset_registry can refresh
+        # each bucket with a single batched copy instead of one H2D transfer per tensor.
+        if self.is_cpu_tensor(replay_t_ids[0]):
+            return
+        dsts, srcs = self._device_masters.setdefault(
+            (tensors.dtype, tensors.device), ([], [])
+        )
+        dsts.append(torch.empty_like(tensors, device=self.device))
+        srcs.append(tensors)
+        dsts[-1].copy_(tensors, non_blocking=True)
+        for replay_t_id, tensor in zip(replay_t_ids, group_rows(dsts[-1], shape)):
+            self.tensor_registry[replay_t_id] = tensor
+
+    def reset_registry(self):
+        # Refresh the device tensors in place, so the tensors in the registry keep their identity
+        # (and address) across resets.
+        for dsts, srcs in self._device_masters.values():
+            if hasattr(torch, "_foreach_copy_"):
+                torch._foreach_copy_(dsts, srcs, non_blocking=True)
+            else:
+                for dst, src in zip(dsts, srcs):
+                    dst.copy_(src, non_blocking=True)
+        # The ops these are fed to may have resized or re-pointed them, so they are not refreshed
+        # in place.
+        for tensor, replay_t_id in self._own_masters:
+            self.tensor_registry[replay_t_id] = tensor.to(
+                self.device, non_blocking=True
+            )
 
     def extract_subgraph(self, root):
         """
         return: all nodes in the subgraph, in the order of node ID
         """
+        # Pre-order traversal with an explicit stack, children are pushed in reverse order
+        # to keep the visiting order (which matters for pairing fbgemm forward/backward ops).
+        stack = list(reversed(root.children))
+        while stack:
+            child = stack.pop()
+            try:
+                if self._skip_re.search(child.name) is not None:
+                    self.actual_skip_nodes.append(child.name)
+                    self.actual_skip_nodes_cnt += 1
+                    continue
+
+                if is_qualified(child):
+                    self.sorted_nodes.append(child)
+                    self.sorted_nodes_set.add(child)
 
-        def _dfs_traverse(root):
-            for child in root.children:
-                try:
-                    if any(x in child.name for x in self.skip_node_names):
+                    self._short_ids(child)
+                    self._fbgemm_flags(child)
+                    self.top_tensors[child] = set(child._in_sids).union(child._out_sids)
+
+                    self.dependency_permanent.update(child._in_sids)
+                    func, output_count = self.build_func(child)
+                    self.funcs[child.id] = (func, output_count)
+                else:
+                    if skip_op(child):
                         self.actual_skip_nodes.append(child.name)
                         self.actual_skip_nodes_cnt += 1
-                        continue
-
-                    if is_qualified(child):
-                        self.sorted_nodes.append(child)
-
-                        self.top_tensors[child] = set()
-                        for _, t_id, _ in get_input_tensors(child):
-                            if self.tensor_with_device:
-                                t_id = tuple(list(t_id)[:5])
-                            self.top_tensors[child].add(t_id)
-                        for _, t_id, _ in get_output_tensors(child):
-                            if self.tensor_with_device:
-                                t_id = tuple(list(t_id)[:5])
-                            self.top_tensors[child].add(t_id)
-
-                        for _, t_id, _ in get_input_tensors(child):
-                            if self.tensor_with_device:
-                                t_id = tuple(list(t_id)[:5])
-                            self.dependency_permanent[t_id] += 1
-                        func, output_count = self.build_func(child)
-                        self.funcs[child.id] = (func, output_count)
-                    else:
-                        if skip_op(child):
-                            self.actual_skip_nodes.append(child.name)
-                            self.actual_skip_nodes_cnt += 1
-                        _dfs_traverse(child)
-                except Exception as e:
-                    print(f"Graph parse error: {e}, node id: {child.id}")
-                    exit(1)
-
-        _dfs_traverse(root)
+                    stack.extend(reversed(child.children))
+            except Exception as e:
+                print(f"Graph parse error: {e}, node id: {child.id}")
+                exit(1)
+
         self.sorted_nodes = sorted(self.sorted_nodes, key=lambda x: x.id)
         print("#Operators to execute: ", len(self.sorted_nodes))
 
     def analyze_subgraph(self, root):
-        def _bfs_traverse(node):
-            for child in node.children:
-                if any(x in child.name for x in self.skip_node_names):
-                    continue
+        stack = list(reversed(root.children))
+        while stack:
+            child = stack.pop()
+            if self._skip_re.search(child.name) is not None:
+                continue
 
-                if is_backward_aten(child) or has_backward_parent(child):
+            if is_backward_aten(child) or has_backward_parent(child):
+                continue
+
+            if child not in self.sorted_nodes_set and child.type == NodeType.OPERATOR:
+                node = child.parent
+                while node and node not in self.sorted_nodes_set:
+                    node = node.parent
+                if not node:
+                    self.exceptional_nodes.add(child)
                     continue
-                else:
+                self._short_ids(child)
+                for (data_type, _, shape), t_id in zip(
+                    self._outs(child), child._out_sids
+                ):
                     if (
-                        child not in self.sorted_nodes
-                        and child.type == NodeType.OPERATOR
+                        t_id not in self.top_tensors[node]
+                        and t_id in self.dependency_permanent
+                        and t_id not in self.additional_tensors
                     ):
-                        node = child.parent
-                        while node and node not in self.sorted_nodes:
-                            node = node.parent
-                        if not node:
-                            self.exceptional_nodes.add(child)
-                            continue
-                        for data_type, t_id, shape in get_output_tensors(child):
-                            if self.tensor_with_device:
-                                t_id = tuple(list(t_id)[:5])
-                            if (
-                                t_id not in self.top_tensors[node]
-                                and t_id in self.dependency_permanent
-                                and t_id not in self.additional_tensors
-                            ):
-                                self.additional_tensors.add(t_id)
-                                if shape:
-                                    self.additional_tensors_size += (
-                                        reduce(lambda x, y: x * y, shape)
-                                        * TORCH_DTYPES_BYTES[
-                                            data_type.lstrip("Tensor(").rstrip(")")
-                                        ]
-                                    )
-                    _bfs_traverse(child)
+                        self.additional_tensors.add(t_id)
+                        if shape:
+                            self.additional_tensors_size += prod(
+                                shape
+                            ) * tensor_dtype_bytes(data_type)
+            stack.extend(reversed(child.children))
 
-        _bfs_traverse(root)
         # print("Exceptional nodes: ")
         # for node in self.exceptional_nodes:
         #     print(node.id, node.name)
@@ -280,153 +431,171 @@ class ExgrReplayManager:
 
     def analyze_tensors(self):
         def add_unique_tensor(node_id, t_id, shape, input, device=-1):
-            # If we did not see this tensor before, add it as a unique tensor.
-            if t_id not in self.original_unique_tensors:
-                self.original_unique_tensors.add(t_id)
+            self.original_unique_tensors.add(t_id)
+            # If we did not see this tensor before, or saw it but with a different shape,
+            # add it as a unique tensor.
+            shape_to_replay_t_id = self.tensor_shape_to_rid[t_id]
+            replay_t_id = shape_to_replay_t_id.get(tuple(shape))
+            if replay_t_id is None:
                 self.replay_unique_tensor_num += 1
-                self.tensors_mapping[
-                    (node_id, t_id, input)
-                ] = self.replay_unique_tensor_num
-                self.replay_tensors_shapes[
-                    self.tensors_mapping[(node_id, t_id, input)]
-                ] = shape
-                self.tensor_shapes[t_id].add(
-                    (self.tensors_mapping[(node_id, t_id, input)], tuple(shape))
-                )
+                replay_t_id = self.replay_unique_tensor_num
+                shape_to_replay_t_id[tuple(shape)] = replay_t_id
+                self.replay_tensors_shapes[replay_t_id] = shape
                 if self.tensor_with_device:
-                    self.tensor_device[
-                        self.tensors_mapping[(node_id, t_id, input)]
-                    ] = device
-                return
-
-            # If we saw this tensor before but with a different shape, add it as a unique tensor.
-            for (relay_t_id, pre_shape) in self.tensor_shapes[t_id]:
-                if tuple(shape) == pre_shape:
-                    self.tensors_mapping[(node_id, t_id, input)] = relay_t_id
-                    return
-
-            self.replay_unique_tensor_num += 1
-            self.tensors_mapping[(node_id, t_id, input)] = self.replay_unique_tensor_num
-            self.replay_tensors_shapes[
-                self.tensors_mapping[(node_id, t_id, input)]
-            ] = shape
-            self.tensor_shapes[t_id].add(
-                (self.tensors_mapping[(node_id, t_id, input)], tuple(shape))
-            )
-            if self.tensor_with_device:
-                self.tensor_device[
-                    self.tensors_mapping[(node_id, t_id, input)]
-                ] = device
+                    self.tensor_device[replay_t_id] = device
+            self.tensors_mapping[(node_id, t_id, input)] = replay_t_id
 
         for node in self.sorted_nodes:
-            for _, t_id, shape in get_input_tensors(node):
-                if self.tensor_with_device:
-                    device = list(t_id)[5]
-                    t_id = tuple(list(t_id)[:5])
-                    if t_id in self.dependency_permanent.keys():
-                        add_unique_tensor(
-                            node.id, t_id, shape, input=True, device=device
-                        )
-                else:
-                    if t_id in self.dependency_permanent.keys():
-                        add_unique_tensor(node.id, t_id, shape, input=True)
+            self._short_ids(node)
+            for (_, _, shape), t_id, device in zip(
+                self._ins(node), node._in_sids, node._in_devices
+            ):
+                if t_id in self.dependency_permanent:
+                    add_unique_tensor(node.id, t_id, shape, input=True, device=device)
 
-            for _, t_id, shape in get_output_tensors(node):
-                if self.tensor_with_device:
-                    device = list(t_id)[5]
-                    t_id = tuple(list(t_id)[:5])
-                    if t_id in self.dependency_permanent.keys():
-                        add_unique_tensor(
-                            node.id, t_id, shape, input=False, device=device
-                        )
-                else:
-                    if t_id in self.dependency_permanent.keys():
-                        add_unique_tensor(node.id, t_id, shape, input=False)
+            for (_, _, shape), t_id, device in zip(
+                self._outs(node), node._out_sids, node._out_devices
+            ):
+                if t_id in self.dependency_permanent:
+                    add_unique_tensor(node.id, t_id, shape, input=False, device=device)
 
         # Simulate the execution progress and record the output tensors we have seen so far.
         output_set = set()
         for node in self.sorted_nodes:
-            for _, t_id, _ in get_input_tensors(node):
-                if self.tensor_with_device:
-                    t_id = tuple(list(t_id)[:5])
+            for t_id in node._in_sids:
                 if (
-                    t_id in self.dependency_permanent.keys()
+                    t_id in self.dependency_permanent
                     and self.tensors_mapping[(node.id, t_id, True)] not in output_set
                 ):
                     self.instantiate.add(self.tensors_mapping[(node.id, t_id, True)])
 
-            for _, t_id, _ in get_output_tensors(node):
-                if self.tensor_with_device:
-                    t_id = tuple(list(t_id)[:5])
-                if t_id in self.dependency_permanent.keys():
+            for t_id in node._out_sids:
+                if t_id in self.dependency_permanent:
                     output_set.add(self.tensors_mapping[(node.id, t_id, False)])
 
     def allocate_tensors(self):
+        # The runtime registry is populated here. It is a list indexed by replay tensor id, which
+        # are dense from 1.
+        self.tensor_registry = [None] * (self.replay_unique_tensor_num + 1)
+        self._device_masters = {}
+        # (dtype, rng, shape, on cpu) -> replay tensor ids to allocate in one batched tensor.
+        alloc_groups = defaultdict(list)
+        ######
+        # Workaround to match offsets for embedding table
+        # Currently assume a uniform distribution.
+        # Replay tensor id of the offsets -> (number of offsets, nnz), filled as soon as the
+        # offsets tensor is materialized, before its H2D copy is issued.
+        offsets_fills = {}
+        for node in self.sorted_nodes:
+            if node.name == "aten::embedding_bag":
+                indices_tensor_shape = node.input_shapes[1][0]
+                offsets_tensor_shape = node.input_shapes[2][0]
+                offsets_fills[
+                    self.tensors_mapping[(node.id, node._in_sids[2], True)]
+                ] = (offsets_tensor_shape, indices_tensor_shape / offsets_tensor_shape)
+        ######
+        # Inputs of the ops that resize or re-point their storage, or address it through a storage
+        # offset, are not allocated as a row view of a group.
+        own_storage = {
+            self.tensors_mapping[(node.id, t_id, True)]
+            for node in self.sorted_nodes
+            if node.name in STORAGE_SENSITIVE_OPS
+            for t_id in node._in_sids
+        }
         for node in self.sorted_nodes:
-            if is_fbgemm_forward(node):
+            # Node level properties, invariant across the inputs of the node.
+            is_eb = node.name == "aten::embedding_bag"
+            is_split = "fbgemm::split_embedding_codegen_lookup" in node.name
+            is_fb = node._is_fbgemm_forward
+            is_pin = node.name == "aten::pin_memory"
+            if is_fb:
                 input_args, _ = generate_fbgemm_tensors(node, self.cuda)
-            for idx, (data_type, t_id, shape) in enumerate(get_input_tensors(node)):
-                if self.tensor_with_device:
-                    t_id = tuple(list(t_id)[:5])
+            for idx, ((data_type, _, shape), t_id) in enumerate(
+                zip(self._ins(node), node._in_sids)
+            ):
                 replay_t_id = self.tensors_mapping[(node.id, t_id, True)]
                 if (
-                    t_id in self.dependency_permanent.keys()
+                    t_id in self.dependency_permanent
                     and replay_t_id not in self.tensor_registry_permanent.keys()
-                    and (
-                        node.name == "aten::embedding_bag"
-                        or "fbgemm::split_embedding_codegen_lookup" in node.name
-                        or replay_t_id in self.instantiate
-                    )
+                    and (is_eb or is_split or replay_t_id in self.instantiate)
                 ):
                     try:
-                        if is_fbgemm_forward(node):
+                        if is_fb:
                             self.tensor_registry_permanent[replay_t_id] = input_args[
                                 idx
                             ]
-                            if "fbgemm::split_embedding_codegen_lookup" in node.name:
+                            if is_split:
                                 self.unchangeable_intermediate_tensors.add(replay_t_id)
                         else:
-                            dtype, rng = TORCH_DTYPES_RNG[
-                                data_type.lstrip("Tensor(").rstrip(")")
-                            ]
-                            self.tensor_registry_permanent[replay_t_id] = rng(shape).to(
-                                dtype
-                            )
-                            if node.name == "aten::embedding_bag":
-                                self.unchangeable_intermediate_tensors.add(replay_t_id)
-                            if node.name == "aten::pin_memory" and idx == 0:
+                            dtype, rng = tensor_dtype_rng(data_type)
+                            if is_pin and idx == 0:
                                 self.cpu_tensor.add(replay_t_id)
+                            if replay_t_id in own_storage:
+                                tensor = torch.empty(
+                                    shape, dtype=dtype, pin_memory=True
+                                ).copy_(rng(shape))
+                                if replay_t_id in offsets_fills:
+                                    fill_offsets(
+                                        tensor, *offsets_fills.pop(replay_t_id)
+                                    )
+                                self.tensor_registry_permanent[replay_t_id] = tensor
+                                if not self.is_cpu_tensor(replay_t_id):
+                                    self._own_masters.append((tensor, replay_t_id))
+                                    self.tensor_registry[replay_t_id] = tensor.to(
+                                        self.device, non_blocking=True
+                                    )
+                            else:
+                                alloc_groups[
+                                    (
+                                        dtype,
+                                        rng,
+                                        tuple(shape),
+                                        self.is_cpu_tensor(replay_t_id),
+                                    )
+                                ].append(replay_t_id)
+                                # Placeholder until the group is allocated below.
+                                self.tensor_registry_permanent[replay_t_id] = None
+                            if is_eb:
+                                self.unchangeable_intermediate_tensors.add(replay_t_id)
                     except KeyError:
                         if data_type != "Tensor(nullptr (uninitialized))":
                             print("KeyError: ", node.id, t_id, data_type)
                         self.tensor_registry_permanent[replay_t_id] = None
 
-            ######
-            # Workaround to match offsets for embedding table
-            # Currently assume a uniform distribution.
-            if node.name == "aten::embedding_bag":
-                indices_tensor_shape = node.input_shapes[1][0]
-                offsets_tensor_shape = node.input_shapes[2][0]
-                nnz = indices_tensor_shape / offsets_tensor_shape
-                for i in range(offsets_tensor_shape):
-                    if self.tensor_with_device:
-                        self.tensor_registry_permanent[
-                            self.tensors_mapping[
-                                (node.id, tuple(node.inputs[2][:5]), True)
-                            ]
-                        ][i] = (i * nnz)
-                    else:
-                        self.tensor_registry_permanent[
-                            self.tensors_mapping[(node.id, tuple(node.inputs[2]), True)]
-                        ][i] = (i * nnz)
-            ######
+        for (dtype, rng, shape, on_cpu), replay_t_ids in alloc_groups.items():
+            # Host tensors are allocated in pinned memory once, they are either the sources of
+            # the H2D copies in reset_registry or the cpu tensors fed to the replayed ops.
+            # The rows are padded so each tensor of the group starts aligned.
+            tensors = torch.empty(
+                (len(replay_t_ids), group_row_numel(shape, dtype)),
+                dtype=dtype,
+                pin_memory=True,
+            )
+            rows = group_rows(tensors, shape)
+            rows.copy_(rng(rows.shape))
+            for replay_t_id, row in zip(replay_t_ids, rows):
+                if replay_t_id in offsets_fills:
+                    fill_offsets(row, *offsets_fills.pop(replay_t_id))
+            self.tensor_registry_permanent.update(zip(replay_t_ids, rows))
+            self.issue_device_master(tensors, replay_t_ids, shape)
+
+        # Offsets that are not generated here (e.g. fbgemm inputs).
+        for replay_t_id, (offsets_tensor_shape, nnz) in offsets_fills.items():
+            fill_offsets(
+                self.tensor_registry_permanent[replay_t_id], offsets_tensor_shape, nnz
+            )
+
+        # Tensors that stay on cpu (or are already on the device) are registered as they are.
+        for replay_t_id, tensor in self.tensor_registry_permanent.items():
+            if self.tensor_registry[replay_t_id] is None:
+                self.tensor_registry[replay_t_id] = tensor
 
     def build_func(self, node):
-        if is_fbgemm_forward(node):
+        if node._is_fbgemm_forward:
             func, output_count = build_fbgemm_func(node, self.cuda)
             self.fbgemm_backward_ops.append((func.backward, node.id))
             return func.forward, output_count
-        elif is_fbgemm_backward(node):
+        elif node._is_fbgemm_backward:
             assert self.fbgemm_backward_ops
             backward_op, forward_id = self.fbgemm_backward_ops.pop(-1)
             return backward_op, len(node.output_types)
@@ -449,67 +618,72 @@ class ExgrReplayManager:
         self.analyze_tensors()
 
         tensor_with_multiple_shape_count = 0
-        for tensor in self.tensor_shapes:
-            if len(self.tensor_shapes[tensor]) != 1:
-                tensor_with_multiple_shape_count += len(self.tensor_shapes[tensor])
+        for shapes in self.tensor_shape_to_rid.values():
+            if len(shapes) != 1:
+                tensor_with_multiple_shape_count += len(shapes)
         print(
-            f"Tensor count with same identifier but different shapes:{tensor_with_multiple_shape_count}, total tensor: {len(self.tensor_shapes)}"
+            f"Tensor count with same identifier but different shapes:{tensor_with_multiple_shape_count}, total tensor: {len(self.tensor_shape_to_rid)}"
         )
 
         if self.generator:
             self.generate_code()
         else:
-            self.allocate_tensors()
-            self.reset_registry()
+            with torch.cuda.stream(self._alloc_stream):
+                self.allocate_tensors()
+            torch.cuda.current_stream().wait_stream(self._alloc_stream)
+            self.build_registry_slots()
+            self.run_nodes = list(self.sorted_nodes)
+            # Debug runs rely on the per op bookkeeping in run_op.
+            if not self.debug:
+                self.build_replay_func()
+            # Collect the preprocessing garbage once, before replay starts.
+            gc.collect()
+            if self.debug:
+                torch.cuda.empty_cache()
 
     def generate_code(self):
         def _generate_tensor_allocation_str():
-            tensor_allocation_str = ""
+            tensor_allocation_str = []
             tensor_allocate_template = """{tensor} = {rng}({shape}).to({dtype}){cuda}"""
             for node in self.sorted_nodes:
-                if is_fbgemm_forward(node):
-                    tensor_allocation_str += f'input_args, _ = generate_fbgemm_tensors(nodes[{node.id}], "{self.cuda}")\n'
+                # Node level properties, invariant across the inputs of the node.
+                is_eb = node.name == "aten::embedding_bag"
+                is_split = "fbgemm::split_embedding_codegen_lookup" in node.name
+                is_fb = node._is_fbgemm_forward
+                is_pin = node.name == "aten::pin_memory"
+                if is_fb:
+                    tensor_allocation_str.append(
+                        f'input_args, _ = generate_fbgemm_tensors(nodes[{node.id}], "{self.cuda}")\n'
+                    )
                     input_args, _ = generate_fbgemm_tensors(node, self.cuda)
-                for idx, (dtype, t_id, shape) in enumerate(get_input_tensors(node)):
-                    if self.tensor_with_device:
-                        t_id = tuple(list(t_id)[:5])
+                for idx, ((dtype, _, shape), t_id) in enumerate(
+                    zip(self._ins(node), node._in_sids)
+                ):
                     replay_t_id = self.tensors_mapping[(node.id, t_id, True)]
                     if (
-                        t_id in self.dependency_permanent.keys()
+                        t_id in self.dependency_permanent
                         and replay_t_id not in self.tensor_registry_permanent.keys()
-                        and (
-                            node.name == "aten::embedding_bag"
-                            or "fbgemm::split_embedding_codegen_lookup" in node.name
-                            or replay_t_id in self.instantiate
-                        )
+                        and (is_eb or is_split or replay_t_id in self.instantiate)
                     ):
                         try:
-                            if is_fbgemm_forward(node):
-                                tensor_allocation_str += (
-                                    f"global tensor_{replay_t_id}\n"
-                                )
-                                tensor_allocation_str += (
-                                    f"tensor_{replay_t_id} = input_args[{idx}]\n"
+                            if is_fb:
+                                tensor_allocation_str.append(
+                                    f"T[{replay_t_id}] = input_args[{idx}]\n"
                                 )
-                                if (
-                                    "fbgemm::split_embedding_codegen_lookup"
-                                    in node.name
-                                ):
+                                if is_split:
                                     self.unchangeable_intermediate_tensors.add(
                                         replay_t_id
                                     )
                             else:
-                                if node.name == "aten::embedding_bag":
+                                if is_eb:
                                     self.unchangeable_intermediate_tensors.add(
                                         replay_t_id
                                     )
-                                if node.name == "aten::pin_memory" and idx == 0:
+                                if is_pin and idx == 0:
                                     self.cpu_tensor.add(replay_t_id)
 
-                                dtype_str, rng_str = TORCH_DTYPES_RNG_str[
-                                    dtype.lstrip("Tensor(").rstrip(")")
-                                ]
-                                tensor_str = f"tensor_{replay_t_id}"
+                                dtype_str, rng_str = tensor_dtype_rng_str(dtype)
+                                tensor_str = f"T[{replay_t_id}]"
                                 shape_str = "[" + ", ".join(str(d) for d in shape) + "]"
                                 cuda_str = ""
                                 if self.tensor_with_device:
@@ -518,8 +692,7 @@ class ExgrReplayManager:
                                 elif replay_t_id not in self.cpu_tensor:
                                     cuda_str = f'.cuda("{self.cuda}")'
 
-                                tensor_allocation_str += f"global {tensor_str}\n"
-                                tensor_allocation_str += (
+                                tensor_allocation_str.append(
                                     tensor_allocate_template.format(
                                         tensor=tensor_str,
                                         rng=rng_str,
@@ -534,310 +707,484 @@ class ExgrReplayManager:
                         except KeyError:
                             if dtype != "Tensor(nullptr (uninitialized))":
                                 print("KeyError: ", node.id, t_id, dtype)
-                            tensor_allocation_str += f"global tensor{replay_t_id}\n"
-                            tensor_allocation_str += f"tensor_{replay_t_id} = None\n"
+                            tensor_allocation_str.append(f"T[{replay_t_id}] = None\n")
                             self.tensor_registry_permanent[replay_t_id] = 1
-            return tensor_allocation_str
+            return "".join(tensor_allocation_str)
+
+        code_str = []
+        code_str.append(generate_prefix(self.exgr_input, self.cuda))
+        # All the replay tensors live in one flat list indexed by replay tensor id.
+        code_str.append(f"T = [None] * {self.replay_unique_tensor_num + 1}\n")
+        code_str.append(_generate_tensor_allocation_str())
+        code_str.append("\n\n")
+
+        code_str.append(self.generate_run_ops_str())
+
+        if self.compile:
+            # The funcs of run_ops are TorchScript functions, which TorchDynamo does not trace
+            # into: every op is a graph break and still runs eagerly, nothing is fused.
+            code_str.append(
+                '\nrun_ops = torch.compile(run_ops, mode="reduce-overhead", fullgraph=False)\n'
+            )
 
-        def _generate_inputs_str(node):
-            inputs = ""
-            if is_fbgemm_forward(node):
-                idx_list = fbgemm_input_args_indices(node)
-                for idx in idx_list:
-                    if self.tensor_with_device:
-                        inputs += f"tensor_{self.tensors_mapping[(node.id, tuple(node.inputs[idx][:5]), True)]}, "
-                    else:
-                        inputs += f"tensor_{self.tensors_mapping[(node.id, tuple(node.inputs[idx]), True)]}, "
-                if is_fbgemm_forward_unweighted(node):
-                    inputs += "None" + ", "
-            else:
-                for idx, item in enumerate(node.inputs):
-                    if (
-                        node.name == "aten::convolution_backward"
-                        and idx == len(node.inputs) - 1
-                    ):
-                        inputs += "[True, True, True], "
-                        continue
-                    if is_tensor(node, idx):
-                        if self.tensor_with_device:
-                            item = tuple(item[:5])
-                        # Workaround to handle tensor with same id but different data types (ads_cmf10x_single_iter_512_newest_eg.json).
-                        if idx == 3 and (
-                            node.name == "aten::index_add_"
-                            or (
-                                node.name == "aten::index_copy_"
-                                and node.input_types[3] == "Tensor(double)"
-                            )
-                        ):
-                            inputs += f"tensor_{self.tensors_mapping[(node.id, tuple(item), True)]}.to(torch.float64), "
-                        else:
-                            inputs += f"tensor_{self.tensors_mapping[(node.id, tuple(item), True)]}, "
-                    elif is_tensor_list(node, idx):
-                        inputs += "["
-                        if self.tensor_with_device:
-                            for t_id in item:
-                                inputs += f"tensor_{self.tensors_mapping[(node.id, tuple(t_id[:5]), True)]}, "
-                        else:
-                            for t_id in item:
-                                inputs += f"tensor_{self.tensors_mapping[(node.id, tuple(t_id), True)]}, "
-                        inputs = inputs[:-2] + "], "
-                    elif item == "<None>" or item == "<Generator>":
-                        inputs += "None" + ", "
-                    elif item == "inf" or item == "-inf":
-                        inputs += f'float("{item}"), '
-                    elif node.input_types[idx] == "Device" and "cuda" in item:
-                        inputs += f'"{self.cuda}", '
-                    elif isinstance(item, str):
-                        inputs += f'"{item}", '
-                    else:
-                        inputs += str(item) + ", "
-            return inputs[:-2]
+        code_str.append(
+            generate_suffix(self.numWarmupIters, self.numIters, self.cuda_graph)
+        )
+        code_str = "".join(code_str)
+        if self.dump:
+            with open(self.dump_path, "w") as f:
+                print(code_str, file=f)
+        # Compile the source once, named after the dumped file (if any) so tracebacks point to it,
+        # and run it in its own namespace.
+        exec(
+            compile(code_str, self.dump_path if self.dump else "<eg_replay>", "exec"),
+            {},
+        )
+        exit(1)
 
-        def _generate_outputs_str(node):
-            def _generate_output_tensor_str(node, output_tensors):
-                (_, t_id, _) = output_tensors.pop(0)
+    def host_written_slots(self):
+        # Registry slots the replayed ops write to: their outputs, and the first input of the in
+        # place ops.
+        if self._host_written_slots is None:
+            self._host_written_slots = set()
+            for node in self.sorted_nodes:
+                keys = [(node.id, t_id, False) for t_id in node._out_sids]
+                if node.name.endswith("_") and node._in_sids:
+                    keys.append((node.id, node._in_sids[0], True))
+                self._host_written_slots.update(
+                    self.tensors_mapping[key]
+                    for key in keys
+                    if key in self.tensors_mapping
+                )
+        return self._host_written_slots
+
+    def async_copy_input_index(self, node):
+        # With --async-h2d-copy, copies from the replay tensors allocated on the host, which are
+        # pinned and not written by any replayed op, are made non blocking, so the host keeps
+        # launching ops while the H2D copy is in flight. This changes the replayed program, it is
+        # off by default. Returns the index of the non_blocking input to set, or None.
+        if not self.async_h2d_copy or self.generator:
+            return None
+        indices = COPY_OPS_NON_BLOCKING_INDEX.get(node.name)
+        if not indices or len(node.inputs) not in indices:
+            return None
+        src_idx = 1 if node.name == "aten::copy_" else 0
+        if not is_tensor(node, src_idx):
+            return None
+        t_id = (
+            node.inputs[src_idx][:5]
+            if self.tensor_with_device
+            else node.inputs[src_idx]
+        )
+        slot = self.tensors_mapping.get((node.id, tuple(t_id), True))
+        if (
+            slot not in self.tensor_registry_permanent
+            or not self.is_cpu_tensor(slot)
+            or slot in self.host_written_slots()
+        ):
+            return None
+        non_blocking_idx = indices[len(node.inputs)]
+        if not isinstance(node.inputs[non_blocking_idx], bool):
+            return None
+        return non_blocking_idx
+
+    def generate_inputs_str(self, node):
+        inputs = []
+        if node._is_fbgemm_forward:
+            for idx in node._fbgemm_idx_list:
+                item = node.inputs[idx]
                 if self.tensor_with_device:
-                    t_id = tuple(list(t_id)[:5])
-                if t_id in self.dependency_permanent.keys():
-                    replay_t_id = self.tensors_mapping[(node.id, t_id, False)]
-                    if (
-                        replay_t_id not in self.unchangeable_intermediate_tensors
-                        and replay_t_id not in self.instantiate
+                    item = item[:5]
+                inputs.append(
+                    f"T[{self.tensors_mapping[(node.id, tuple(item), True)]}]"
+                )
+            if node._is_fbgemm_forward_unweighted:
+                inputs.append("None")
+        else:
+            non_blocking_idx = self.async_copy_input_index(node)
+            for idx, item in enumerate(node.inputs):
+                if (
+                    node.name == "aten::convolution_backward"
+                    and idx == len(node.inputs) - 1
+                ):
+                    inputs.append("[True, True, True]")
+                    continue
+                if idx == non_blocking_idx:
+                    inputs.append("True")
+                    continue
+                if is_tensor(node, idx):
+                    if self.tensor_with_device:
+                        item = tuple(item[:5])
+                    # Workaround to handle tensor with same id but different data types (ads_cmf10x_single_iter_512_newest_eg.json).
+                    if idx == 3 and (
+                        node.name == "aten::index_add_"
+                        or (
+                            node.name == "aten::index_copy_"
+                            and node.input_types[3] == "Tensor(double)"
+                        )
                     ):
-                        return f"tensor_{replay_t_id}"
-                return "_"
-
-            def _parse_element_type(node, output_type, output_tensors):
-                outputs = ""
-                if output_type.startswith("Tensor"):
-                    outputs += _generate_output_tensor_str(node, output_tensors) + ", "
-                elif output_type.startswith("GenericList"):
-                    outputs += "["
-                    elements_type = output_type[12:-1].split(",")
-                    for element_type in elements_type:
-                        outputs += _parse_element_type(
-                            node, element_type, output_tensors
+                        inputs.append(
+                            f"T[{self.tensors_mapping[(node.id, tuple(item), True)]}].to(torch.float64)"
                         )
-                    outputs = outputs[:-2] + "], "
+                    else:
+                        inputs.append(
+                            f"T[{self.tensors_mapping[(node.id, tuple(item), True)]}]"
+                        )
+                elif is_tensor_list(node, idx):
+                    if self.tensor_with_device:
+                        tensors = [
+                            f"T[{self.tensors_mapping[(node.id, tuple(t_id[:5]), True)]}]"
+                            for t_id in item
+                        ]
+                    else:
+                        tensors = [
+                            f"T[{self.tensors_mapping[(node.id, tuple(t_id), True)]}]"
+                            for t_id in item
+                        ]
+                    inputs.append("[" + ", ".join(tensors) + "]")
+                elif item == "<None>" or item == "<Generator>":
+                    inputs.append("None")
+                elif item == "inf" or item == "-inf":
+                    inputs.append(f'float("{item}")')
+                elif node.input_types[idx] == "Device" and "cuda" in item:
+                    inputs.append(repr(self.cuda))
                 else:
-                    outputs += "_, "
-                return outputs
-
-            try:
-                outputs = ""
-                output_tensors = get_output_tensors(node)
-                if len(output_tensors) == 0:
-                    return "_"
+                    inputs.append(constant_str(item))
+        return ", ".join(inputs)
+
+    def generate_outputs_str(self, node):
+        def _generate_output_tensor_str(node, output_tensors):
+            t_id = output_tensors.pop(0)
+            if t_id in self.dependency_permanent:
+                replay_t_id = self.tensors_mapping[(node.id, t_id, False)]
+                if (
+                    replay_t_id not in self.unchangeable_intermediate_tensors
+                    and replay_t_id not in self.instantiate
+                ):
+                    return f"T[{replay_t_id}]"
+            return "_"
+
+        def _parse_element_type(node, output_type, output_tensors):
+            if output_type.startswith("Tensor"):
+                return _generate_output_tensor_str(node, output_tensors)
+            elif output_type.startswith("GenericList"):
+                elements_type = output_type[12:-1].split(",")
+                return (
+                    "["
+                    + ", ".join(
+                        _parse_element_type(node, element_type, output_tensors)
+                        for element_type in elements_type
+                    )
+                    + "]"
+                )
+            else:
+                return "_"
 
-                for output_type in node.output_types:
-                    outputs += _parse_element_type(node, output_type, output_tensors)
+        try:
+            output_tensors = list(node._out_sids)
+            if len(output_tensors) == 0:
+                return "_"
 
-                assert len(output_tensors) == 0
-                return outputs[:-2]
-            except Exception as e:
-                print("Generate outputs error: ", e, node.id)
-                exit(1)
+            outputs = [
+                _parse_element_type(node, output_type, output_tensors)
+                for output_type in node.output_types
+            ]
 
-        code_str = ""
-        code_str += generate_prefix(self.exgr_input, self.cuda)
-        code_str += _generate_tensor_allocation_str()
-        code_str += "\n\n"
+            assert len(output_tensors) == 0
+            return ", ".join(outputs)
+        except Exception as e:
+            print("Generate outputs error: ", e, node.id)
+            exit(1)
 
-        code_str += "def run_ops():\n"
-        exec_template = """    {outputs} = {func}[0]({inputs})"""
-        for node in self.sorted_nodes:
+    def generate_run_ops_str(self):
+        code_str = []
+        # Bind T and the func of every node as locals of run_ops, so each call dispatches on a
+        # local variable instead of a lookup in funcs.
+        args_str = ["    T=T,\n"]
+        exec_template = """    {outputs} = {func}({inputs})"""
+        for node in self.run_nodes:
             func, output_count = self.funcs[node.id]
             if not func:
                 continue
-            func_str = f"funcs[{node.id}]"
-            inputs_str = _generate_inputs_str(node)
-            outputs_str = _generate_outputs_str(node)
-            code_str += f"    # node id: {node.id}\n"
-            code_str += (
+            func_str = f"f{node.id}"
+            args_str.append(f"    {func_str}=funcs[{node.id}][0],\n")
+            inputs_str = self.generate_inputs_str(node)
+            outputs_str = self.generate_outputs_str(node)
+            # The node is named on the line of its call, which is the line a traceback shows.
+            code_str.append(
                 exec_template.format(
                     outputs=outputs_str, func=func_str, inputs=inputs_str
                 )
-                + "\n"
+                + f"  # node id: {node.id}, name: {node.name}\n"
+            )
+        body_str = "".join(code_str) or "    pass\n"
+        return "def run_ops(\n" + "".join(args_str) + "):\n" + body_str
+
+    def build_replay_func(self):
+        # Specialize the whole replay into one straight-line function, with the registry lookups,
+        # the per op workarounds and the output assignments resolved once here instead of in
+        # run_op on every iteration.
+        run_ops_str = self.generate_run_ops_str()
+        filename = "<eg_replay_ops>"
+        if self.profile_memory:
+            # The stacks of the memory snapshot only carry the file and line of each frame, write
+            # the source out so the line of an allocation resolves to its node.
+            filename = RUN_OPS_FILE
+            with open(filename, "w") as f:
+                f.write(run_ops_str)
+        # Register the source so the tracebacks of the replayed ops show the failing line, and the
+        # node id and name on it.
+        linecache.cache[filename] = (
+            len(run_ops_str),
+            None,
+            run_ops_str.splitlines(True),
+            filename,
+        )
+        namespace = {"torch": torch, "T": self.tensor_registry, "funcs": self.funcs}
+        exec(compile(run_ops_str, filename, "exec"), namespace)
+        self.replay_func = namespace["run_ops"]
+        if self.compile:
+            # Same as the generated code. The funcs are TorchScript functions TorchDynamo does not
+            # trace into, each op is a graph break and runs eagerly under the compiled frame.
+            self.replay_func = torch.compile(
+                self.replay_func, mode="reduce-overhead", fullgraph=False
             )
 
-        code_str += generate_suffix(self.numWarmupIters, self.numIters)
-        if self.dump:
-            with open(self.dump_path, "w") as f:
-                print(code_str, file=f)
-        exec(code_str)
-        exit(1)
+    def build_registry_slots(self):
+        # Resolve the registry slots (replay tensor ids) of the input and output tensors of every
+        # node once, so that run_op does not rebuild and hash the tensor id tuples on every iteration.
+        # The per op input workarounds of run_op are resolved here too.
+        def input_slot(node, t_id):
+            if self.tensor_with_device:
+                t_id = t_id[:5]
+            return self.tensors_mapping[(node.id, tuple(t_id), True)]
 
-    def get_inputs(self, node):
-        try:
-            if is_fbgemm_forward(node):
-                idx_list = fbgemm_input_args_indices(node)
-                if self.tensor_with_device:
-                    inputs = [
-                        self.tensor_registry[
-                            self.tensors_mapping[
-                                (node.id, tuple(node.inputs[idx][:5]), True)
-                            ]
-                        ]
-                        for idx in idx_list
-                    ]
-                else:
-                    inputs = [
-                        self.tensor_registry[
-                            self.tensors_mapping[
-                                (node.id, tuple(node.inputs[idx]), True)
-                            ]
-                        ]
-                        for idx in idx_list
-                    ]
-                if is_fbgemm_forward_unweighted(node):
-                    inputs.append(None)
+        for node in self.sorted_nodes:
+            if node.name == "aten::convolution_backward":
+                node._fixup = fix_convolution_backward_inputs
+            elif node.name == "aten::index_add_" or (
+                node.name == "aten::index_copy_"
+                and node.input_types[3] == "Tensor(double)"
+            ):
+                node._fixup = fix_double_source_inputs
             else:
-                inputs = []
-                for idx, item in enumerate(node.inputs):
-                    if is_tensor(node, idx):
-                        self.lookup_cnt += 1
-                        if self.tensor_with_device:
-                            item = tuple(item[:5])
-                        inputs.append(
-                            self.tensor_registry[
-                                self.tensors_mapping[(node.id, tuple(item), True)]
-                            ]
-                        )
-                    elif is_tensor_list(node, idx):
-                        self.lookup_cnt += len(item)
-                        if self.tensor_with_device:
-                            inputs.append(
-                                [
-                                    self.tensor_registry[
-                                        self.tensors_mapping[
-                                            (node.id, tuple(t_id[:5]), True)
-                                        ]
-                                    ]
-                                    for t_id in item
-                                ]
-                            )
-                        else:
-                            inputs.append(
-                                [
-                                    self.tensor_registry[
-                                        self.tensors_mapping[
-                                            (node.id, tuple(t_id), True)
-                                        ]
-                                    ]
-                                    for t_id in item
-                                ]
-                            )
+                node._fixup = None
+
+            # Slots of the outputs to write back to the registry, None for the outputs to discard:
+            # those no other node depends on, and those that must keep their allocated value.
+            output_slots = []
+            for t_id in node._out_sids:
+                slot = None
+                if t_id in self.dependency_permanent:
+                    slot = self.tensors_mapping[(node.id, t_id, False)]
+                    if (
+                        slot in self.unchangeable_intermediate_tensors
+                        or slot in self.instantiate
+                    ):
+                        slot = None
+                output_slots.append(slot)
+            node._output_slots = tuple(output_slots)
+            node._output_kinds = None
+            if node._is_fbgemm_forward:
+                node._lookup_cnt = 0
+                node._input_kinds = ()
+                node._input_slots = tuple(
+                    input_slot(node, node.inputs[idx])
+                    for idx in node._fbgemm_idx_list or ()
+                )
+                continue
+            kinds = []
+            slots = []
+            non_blocking_idx = self.async_copy_input_index(node)
+            for idx, item in enumerate(node.inputs):
+                if is_tensor(node, idx):
+                    kinds.append(INPUT_TENSOR)
+                    slots.append(input_slot(node, item))
+                elif is_tensor_list(node, idx):
+                    kinds.append(INPUT_TENSOR_LIST)
+                    slots.append(tuple(input_slot(node, t_id) for t_id in item))
+                else:
+                    # Non tensor inputs are resolved to their values once.
+                    kinds.append(INPUT_CONSTANT)
+                    if idx == non_blocking_idx:
+                        slots.append(True)
                     elif item == "<None>" or item == "<Generator>":
-                        inputs.append(None)
+                        slots.append(None)
                     elif item == "inf" or item == "-inf":
-                        inputs.append(float(item))
+                        slots.append(float(item))
                     elif node.input_types[idx] == "Device" and "cuda" in item:
-                        inputs.append(self.cuda)
+                        slots.append(self.cuda)
                     else:
-                        inputs.append(item)
-            return inputs
-        except Exception as e:
-            print(f"Inputs error: {e} at node: {node.id}")
-
-    def run_op(self, node, iter):
-        if self.debug and iter >= self.numWarmupIters:
-            start_ns = time.time_ns()
-
-        func, output_count = self.funcs[node.id]
-        if not func:
-            return
-        inputs = self.get_inputs(node)
-
-        # Workaround to eliminate the "strides() called on undefined Tensor" error.
-        if node.name == "aten::convolution_backward":
-            inputs[-1] = [True, True, True]
-
-        # Workaround to handle tensor with same id but different data types (ads_cmf10x_single_iter_512_newest_eg.json).
-        if node.name == "aten::index_add_":
-            inputs[3] = inputs[3].to(torch.float64)
-        if node.name == "aten::index_copy_":
-            if node.input_types[3] == "Tensor(double)":
-                inputs[3] = inputs[3].to(torch.float64)
+                        slots.append(item)
+            node._input_kinds = tuple(kinds)
+            node._input_slots = tuple(slots)
+            # Number of registry lookups of get_inputs, for the debug stats.
+            node._lookup_cnt = sum(
+                1 if kind == INPUT_TENSOR else len(slot)
+                for kind, slot in zip(kinds, slots)
+                if kind != INPUT_CONSTANT
+            )
 
-        # if self.debug and iter >= self.numWarmupIters:
-        #     self.input_total_time += time.time_ns() - start_ns
+    def get_inputs_fast(self, node):
+        registry = self.tensor_registry
+        if node._is_fbgemm_forward:
+            inputs = [registry[slot] for slot in node._input_slots]
+            if node._is_fbgemm_forward_unweighted:
+                inputs.append(None)
+        else:
+            inputs = []
+            for kind, slot in zip(node._input_kinds, node._input_slots):
+                if kind == INPUT_TENSOR:
+                    inputs.append(registry[slot])
+                elif kind == INPUT_TENSOR_LIST:
+                    inputs.append([registry[t_slot] for t_slot in slot])
+                else:
+                    inputs.append(slot)
+        return inputs
 
-        if self.debug and iter >= self.numWarmupIters:
-            before_execution = time.time_ns()
+    def call_op(self, node, func, output_count, inputs):
+        outputs = []
+        if output_count == 0:
+            func(*inputs)
+        else:
+            if output_count == 1:
+                tmp = (func(*inputs),)
+            else:
+                tmp = func(*inputs)
+            # Flatten any tensor lists
+            if not tmp:
+                print(f"Not expect that {node.id} has no output.")
+                return None
+            # The kind of each output only depends on the op, it is recorded on the first run.
+            if node._output_kinds is None:
+                node._output_kinds = tuple(
+                    OUTPUT_TENSOR_LIST
+                    if isinstance(x, list) and isinstance(x[0], torch.Tensor)
+                    else OUTPUT_TENSOR
+                    if isinstance(x, torch.Tensor)
+                    else OUTPUT_OTHER
+                    for x in tmp
+                )
+            for kind, x in zip(node._output_kinds, tmp):
+                if kind == OUTPUT_TENSOR:
+                    outputs.append(x)
+                elif kind == OUTPUT_TENSOR_LIST:
+                    outputs.extend(x)
+        return outputs
 
+    def run_op(self, node, iter):
+        # Used in the warmup iterations: the nodes that fail are reported, and skipped by the
+        # following iterations.
         try:
-            outputs = []
-            if output_count == 0:
-                func(*inputs)
-            else:
-                if output_count == 1:
-                    tmp = (func(*inputs),)
-                else:
-                    tmp = func(*inputs)
-                # Flatten any tensor lists
-                # TODO: Simplify this
-                if not tmp:
-                    print(f"Not expect that {node.id} has no output.")
-                    return
-                for x in tmp:
-                    if isinstance(x, list) and isinstance(x[0], torch.Tensor):
-                        outputs.extend(x)
-                    elif isinstance(x, torch.Tensor):
-                        outputs.append(x)
+            self.run_op_fast(node, iter)
         except Exception as e:
             print(
-                f"Run op exception Error: {e}, node id: {node.id}, func: {func}, inputs: {inputs}"
+                f"Run op exception Error: {e}, node id: {node.id}, name: {node.name}, inputs: {node.inputs}"
             )
-            exit(1)
+            self.failed_nodes.add(node.id)
+            self.run_nodes = [
+                n for n in self.sorted_nodes if n.id not in self.failed_nodes
+            ]
 
-        if self.debug and iter >= self.numWarmupIters:
-            after_execution = time.time_ns()
+    def run_op_fast(self, node, iter):
+        func, output_count = self.funcs[node.id]
+        if not func:
+            return
+        inputs = self.get_inputs_fast(node)
+        if self.debug:
+            self.lookup_cnt += node._lookup_cnt
 
-        for (_, t_id, _), output in zip(get_output_tensors(node), outputs):
-            if self.tensor_with_device:
-                t_id = tuple(list(t_id)[:5])
-            if (
-                t_id in self.dependency_permanent.keys()
-                and self.tensors_mapping[(node.id, t_id, False)]
-                not in self.unchangeable_intermediate_tensors
-            ):
-                if self.tensors_mapping[(node.id, t_id, False)] not in self.instantiate:
-                    self.tensor_registry[
-                        self.tensors_mapping[(node.id, t_id, False)]
-                    ] = output
+        # Per op workarounds, resolved in build_registry_slots.
+        if node._fixup:
+            node._fixup(inputs)
 
-        # if self.debug and iter >= self.numWarmupIters:
-        #     self.output_total_time += time.time_ns() - after_execution
+        if self.debug:
+            # Label the op in the profiler trace, which gives its CPU and GPU times.
+            with torch.profiler.record_function(f"{node.name} (node {node.id})"):
+                outputs = self.call_op(node, func, output_count, inputs)
+        else:
+            outputs = self.call_op(node, func, output_count, inputs)
+        if outputs is None:
+            return
 
-        if self.profile_memory:
-            self.op_allocated_mem[node] = (
-                torch.cuda.memory_allocated(self.device) - self.current_allocated_mem
-            )
-            self.current_allocated_mem = torch.cuda.memory_allocated(self.device)
-            self.op_reserved_mem[node] = (
-                torch.cuda.memory_reserved(self.device) - self.current_reserved_mem
-            )
-            self.current_reserved_mem = torch.cuda.memory_reserved(self.device)
+        registry = self.tensor_registry
+        for slot, output in zip(node._output_slots, outputs):
+            if slot is not None:
+                registry[slot] = output
+
+    def replay_iteration(self, iter):
+        # Errors are reported in the warmup iterations (at least the first one) only. With the
+        # generated run_ops, only the first one is checked, the others warm run_ops up.
+        if iter < (1 if self.replay_func else max(self.numWarmupIters, 1)):
+            failed_cnt = len(self.failed_nodes)
+            for node in self.run_nodes:
+                self.run_op(node, iter)
+            if self.replay_func and len(self.failed_nodes) > failed_cnt:
+                # Regenerate run_ops without the failed nodes.
+                self.build_replay_func()
+        elif self.replay_func:
+            self.replay_func(self.tensor_registry)
+        else:
+            for node in self.run_nodes:
+                self.run_op_fast(node, iter)
 
-        if self.debug and iter >= self.numWarmupIters:
-            self.setup_time.append(
-                time.time_ns() - start_ns - (after_execution - before_execution)
-            )
-            self.exec_time.append(after_execution - before_execution)
+    def capture_cuda_graph(self, iter):
+        # Ops that change the shape or storage of their inputs, or synchronize with the host,
+        # cannot be replayed from a graph, keep the replay eager for such graphs.
+        for node in self.sorted_nodes:
+            if node.name in CUDA_GRAPH_UNSAFE_OPS or any(
+                self.is_cpu_tensor(self.tensors_mapping[(node.id, t_id, True)])
+                for t_id in node._in_sids
+                if (node.id, t_id, True) in self.tensors_mapping
+            ):
+                print(f"Node {node.id} {node.name} cannot be captured, replay eagerly.")
+                return None
+
+        # Warm up on the replay stream, a side stream as required before capture, then capture
+        # one iteration. The outputs of the captured ops stay in tensor_registry, so the graph
+        # reuses the same memory on every replay.
+        with torch.cuda.stream(self._replay_stream):
+            self.replay_iteration(iter)
+
+        graph = torch.cuda.CUDAGraph()
+        capture_kwargs = {"stream": self._replay_stream}
+        # Only the capturing thread is checked for unsafe CUDA calls during the capture, where
+        # supported (not in older PyTorch).
+        if "capture_error_mode" in inspect.signature(torch.cuda.graph).parameters:
+            capture_kwargs["capture_error_mode"] = "thread_local"
+        try:
+            with torch.cuda.graph(graph, **capture_kwargs):
+                self.replay_iteration(iter)
+        except RuntimeError as e:
+            print(f"CUDA graph capture failed: {e}, replay eagerly.")
+            torch.cuda.synchronize()
+            return None
+        return graph
+
+    def start_memory_profile(self, record_memory_history):
+        # Memory is profiled around the measured iterations, the warmup ones are left out.
+        torch.cuda.reset_peak_memory_stats(self.device)
+        if record_memory_history:
+            torch.cuda.memory._record_memory_history(max_entries=100000)
 
     def analyze_ops(self):
         fused_cnt = 0
         aten_up_cnt = 0
         aten_cnt = 0
         custom_cnt = 0
+        # Collect the name patterns of each op in a single scan, then classify by precedence.
+        op_pattern_re = re.compile(
+            r"fused|aten::record_stream|aten::set_|aten::|fbgemm::|fb::"
+        )
         for op in self.actual_skip_nodes:
-            if "fused" in op:
+            patterns = set(op_pattern_re.findall(op))
+            if "fused" in patterns:
                 fused_cnt += 1
-            elif "aten::record_stream" in op or "aten::set_" in op:
+            elif "aten::record_stream" in patterns or "aten::set_" in patterns:
                 aten_up_cnt += 1
-            elif "aten::" in op:
+            elif "aten::" in patterns:
                 aten_cnt += 1
-            elif "fb::" in op or "fbgemm::" in op:
+            elif patterns:
                 custom_cnt += 1
             else:
                 print(op)
@@ -854,18 +1201,38 @@ class ExgrReplayManager:
             return
         print("Start to execution: ")
         time.sleep(2)
-        total_time = 0.0
-        event_1 = torch.cuda.Event(enable_timing=True)
-        event_2 = torch.cuda.Event(enable_timing=True)
+        # Timing events of every iteration. They are recorded without synchronizing the host, which
+        # keeps launching the next iterations, and only read once the replay is finished.
+        iter_events = [
+            (
+                torch.cuda.Event(enable_timing=True),
+                torch.cuda.Event(enable_timing=True),
+            )
+            for _ in range(self.numWarmupIters + self.numIters)
+        ]
 
         if self.eg:
             eg_file = "/tmp/replay_eg.json"
             eg = ExecutionGraphObserver()
             eg.register_callback(eg_file)
 
+        # The replay stream starts after the tensor preparation issued so far.
+        self._replay_stream.wait_stream(torch.cuda.current_stream())
+
         # Print real time qps every # iterations.
         qps_print_interval = 10
 
+        graph = None
+
+        # Record the allocator events along with their stacks, instead of polling the memory
+        # stats after every op. Not available in older PyTorch, only the peak stats are reported.
+        record_memory_history = (
+            self.profile_memory
+            and hasattr(torch.cuda.memory, "_dump_snapshot")
+            and "max_entries"
+            in inspect.signature(torch.cuda.memory._record_memory_history).parameters
+        )
+
         prev_iter = self.numWarmupIters
         if self.profile_replay:
             with torch.profiler.profile(
@@ -884,6 +1251,8 @@ class ExgrReplayManager:
                 # profile_memory=True,
             ) as prof:
                 for iter in range(self.numWarmupIters + self.numIters):
+                    if self.profile_memory and iter == self.numWarmupIters:
+                        self.start_memory_profile(record_memory_history)
                     if self.eg:
                         if iter == self.numWarmupIters:
                             eg.start()
@@ -893,6 +1262,8 @@ class ExgrReplayManager:
                     if iter == prev_iter:
                         start_ns = time.time_ns()
                     if iter == prev_iter + qps_print_interval:
+                        # Wait for the previous iterations to finish on the device.
+                        iter_events[iter - 1][1].synchronize()
                         print(
                             "Current QPS: ",
                             int(
@@ -909,19 +1280,34 @@ class ExgrReplayManager:
                         )
                         prev_iter = iter
                         start_ns = time.time_ns()
-                    event_1.record()
-                    for node in self.sorted_nodes:
-                        self.run_op(node, iter)
-                    event_2.record()
-                    torch.cuda.synchronize()
-                    if iter >= self.numWarmupIters:
-                        total_time += event_1.elapsed_time(event_2)
-                    # Comment out this for now since it will introduce additional cudaMalloc.
-                    # self.reset_registry()
+                    with torch.cuda.stream(self._replay_stream):
+                        if self.cuda_graph and iter == self.numWarmupIters:
+                            graph = self.capture_cuda_graph(iter)
+                        event_1, event_2 = iter_events[iter]
+                        event_1.record()
+                        if graph:
+                            graph.replay()
+                        else:
+                            self.replay_iteration(iter)
+                        event_2.record()
+                        if self.reset_inputs:
+                            self.reset_registry()
                     prof.step()
                 print("Execution finished!")
+            if self.debug:
+                # Per op times, from the ops labeled in run_op. The CUDA time columns are named
+                # device time in recent PyTorch.
+                averages = prof.key_averages()
+                sort_by = (
+                    "self_device_time_total"
+                    if averages and hasattr(averages[0], "self_device_time_total")
+                    else "self_cuda_time_total"
+                )
+                print(averages.table(sort_by=sort_by, row_limit=100))
         else:
             for iter in range(self.numWarmupIters + self.numIters):
+                if self.profile_memory and iter == self.numWarmupIters:
+                    self.start_memory_profile(record_memory_history)
                 if self.eg:
                     if iter == self.numWarmupIters:
                         eg.start()
@@ -931,6 +1317,8 @@ class ExgrReplayManager:
                 if iter == prev_iter:
                     start_ns = time.time_ns()
                 if iter == prev_iter + qps_print_interval:
+                    # Wait for the previous iterations to finish on the device.
+                    iter_events[iter - 1][1].synchronize()
                     print(
                         "Current QPS: ",
                         int(
@@ -946,63 +1334,67 @@ class ExgrReplayManager:
                     )
                     prev_iter = iter
                     start_ns = time.time_ns()
-                event_1.record()
-                for node in self.sorted_nodes:
-                    self.run_op(node, iter)
-                event_2.record()
-                torch.cuda.synchronize()
-                if iter >= self.numWarmupIters:
-                    total_time += event_1.elapsed_time(event_2)
-                # self.reset_registry()
+                with torch.cuda.stream(self._replay_stream):
+                    if self.cuda_graph and iter == self.numWarmupIters:
+                        graph = self.capture_cuda_graph(iter)
+                    event_1, event_2 = iter_events[iter]
+                    event_1.record()
+                    if graph:
+                        graph.replay()
+                    else:
+                        self.replay_iteration(iter)
+                    event_2.record()
+                    if self.reset_inputs:
+                        self.reset_registry()
             print("Execution finished!")
 
+        torch.cuda.synchronize()
+        total_time = sum(
+            event_1.elapsed_time(event_2)
+            for event_1, event_2 in iter_events[self.numWarmupIters :]
+        )
+
+        if record_memory_history:
+            memory_snapshot_file = "/tmp/replay_memory_snapshot.pickle"
+            torch.cuda.memory._dump_snapshot(memory_snapshot_file)
+            torch.cuda.memory._record_memory_history(enabled=None)
+            print(
+                f"Memory snapshot: {memory_snapshot_file}, view it at https://pytorch.org/memory_viz"
+            )
+            if self.replay_func:
+                print(f"The replayed ops of the snapshot stacks are in {RUN_OPS_FILE}")
         if self.profile_memory:
-            print("Allocated GPU memory(B):")
-            for node in dict(
-                sorted(
-                    self.op_allocated_mem.items(),
-                    key=lambda item: item[1],
-                    reverse=True,
-                )[:100]
-            ):
-                print(node.id, self.op_allocated_mem[node])
-            print("Reserved GPU memory(B):")
-            for node in dict(
-                sorted(
-                    self.op_reserved_mem.items(), key=lambda item: item[1], reverse=True
-                )[:100]
-            ):
-                print(node.id, self.op_reserved_mem[node])
+            print(
+                "Peak allocated GPU memory(B): ",
+                torch.cuda.max_memory_allocated(self.device),
+            )
+            print(
+                "Peak reserved GPU memory(B): ",
+                torch.cuda.max_memory_reserved(self.device),
+            )
 
         print("Replay time per iteration: {:.2f} ms".format(total_time / self.numIters))
 
+        # The nodes that failed in warmup are not replayed, they are not covered.
+        replayed_nodes_cnt = len(self.sorted_nodes) - len(self.failed_nodes)
         print(
             "Operator coverage: {} / {} = {}".format(
-                len(self.sorted_nodes),
+                replayed_nodes_cnt,
                 len(self.sorted_nodes) + self.actual_skip_nodes_cnt,
-                len(self.sorted_nodes)
+                replayed_nodes_cnt
                 / (len(self.sorted_nodes) + self.actual_skip_nodes_cnt),
             )
         )
+        if self.failed_nodes:
+            print("Nodes failed in warmup: ", sorted(self.failed_nodes))
         end_time = datetime.now()
         generate_query_url(start_time, end_time, self.cuda_id)
 
         if self.debug:
-            print("Setup time: {}".format(sum(self.setup_time) / 1000000.0))
-            print("Execution time: {}".format(sum(self.exec_time) / 1000000.0))
-
-            print("Input time: {}".format(self.input_total_time / 1000000.0))
-            print("Output time: {}".format(self.output_total_time / 1000000.0))
             print("Lookup count: {}".format(self.lookup_cnt))
             print("Remap tensor list size: ", len(self.tensors_mapping))
-
-            print(
-                "Execution time: 50th:{}ms\t90th:{}ms\t95th:{}ms".format(
-                    np.percentile(self.exec_time, 50) / 1000.0,
-                    np.percentile(self.exec_time, 90) / 1000.0,
-                    np.percentile(self.exec_time, 95) / 1000.0,
-                )
-            )
+            if not self.profile_replay:
+                print("Pass --profile-replay for the per op times.")
 
 
 def main():
@@ -1066,6 +1458,39 @@ def main():
         default="./benchmark.py",
         help="Path to dump generated benchmark file.",
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Wrap the generated run_ops with torch.compile (reduce-overhead mode). The replayed "
+        "ops are TorchScript functions that TorchDynamo does not trace into, so every op is a "
+        "graph break and runs eagerly, nothing is fused.",
+    )
+    parser.add_argument(
+        "--cuda-graph",
+        action="store_true",
+        default=False,
+        help="Capture the replayed ops into a CUDA graph after warmup and replay the graph.",
+    )
+    parser.add_argument(
+        "--enable-jit-profiling",
+        dest="disable_jit_profiling",
+        action="store_false",
+        default=True,
+        help="Keep the TorchScript profiling executor for the replayed ops, disabled by default.",
+    )
+    parser.add_argument(
+        "--reset-inputs",
+        action="store_true",
+        default=False,
+        help="Restore the replay input tensors from their host copies after every iteration.",
+    )
+    parser.add_argument(
+        "--async-h2d-copy",
+        action="store_true",
+        default=False,
+        help="Make the recorded copies from pinned, read-only host inputs to the GPU non blocking.",
+    )
 
     args = parser.parse_args()
 
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 import torch
 from fbgemm_gpu.split_table_batched_embeddings_ops import PoolingMode, WeightDecayMode
@@ -52,6 +53,58 @@ TORCH_DTYPES_BYTES = {
     "c10::Half": 2,
 }
 
+# Bytes of an element of each torch dtype above.
+TORCH_DTYPE_ELEMENT_BYTES = {
+    TORCH_DTYPES_RNG[dtype][0]: elem_bytes
+    for dtype, elem_bytes in TORCH_DTYPES_BYTES.items()
+}
+
+# Ops that resize or re-point their inputs, or synchronize with the host, which a CUDA graph
+# replay cannot reproduce.
+CUDA_GRAPH_UNSAFE_OPS = {
+    "aten::resize_",
+    "aten::set_",
+    "aten::item",
+    "aten::_local_scalar_dense",
+    "aten::nonzero",
+    "aten::pin_memory",
+    "aten::record_stream",
+}
+
+# Ops that resize or re-point the storage of their inputs, or address it through a recorded
+# storage offset, whose inputs cannot be views of a shared storage.
+STORAGE_SENSITIVE_OPS = {
+    "aten::resize_",
+    "aten::resize_as_",
+    "aten::set_",
+    "aten::as_strided",
+    "aten::as_strided_",
+    "aten::record_stream",
+}
+
+
+@lru_cache(maxsize=None)
+def parse_tensor_dtype(data_type):
+    # e.g. Tensor(float) -> float
+    if data_type.startswith("Tensor(") and data_type.endswith(")"):
+        return data_type[len("Tensor(") : -1]
+    return data_type
+
+
+@lru_cache(maxsize=None)
+def tensor_dtype_rng(data_type):
+    return TORCH_DTYPES_RNG[parse_tensor_dtype(data_type)]
+
+
+@lru_cache(maxsize=None)
+def tensor_dtype_rng_str(data_type):
+    return TORCH_DTYPES_RNG_str[parse_tensor_dtype(data_type)]
+
+
+@lru_cache(maxsize=None)
+def tensor_dtype_bytes(data_type):
+    return TORCH_DTYPES_BYTES[parse_tensor_dtype(data_type)]
+
 
 def is_tensor_list(n, idx):
     return isinstance(idx, int) and "GenericList[Tensor" in n.input_types[idx]
@@ -497,7 +550,10 @@ torch.cuda.empty_cache()
     return template_prefix.format(eg_input=eg_input, cuda=cuda)
 
 
-def generate_suffix(warmup_iter, replay_iter):
+def generate_suffix(warmup_iter, replay_iter, cuda_graph=False):
+    if cuda_graph:
+        return generate_cuda_graph_suffix(warmup_iter, replay_iter)
+
     template_suffix = """
 with torch.profiler.profile(
     activities=[
@@ -518,3 +574,41 @@ with torch.profiler.profile(
 
 """
     return template_suffix.format(warmup_iter=warmup_iter, replay_iter=replay_iter)
+
+
+def generate_cuda_graph_suffix(warmup_iter, replay_iter):
+    # Warm up eagerly, then capture run_ops into a CUDA graph once and replay the graph.
+    # The inputs are entries of the T list allocated once, so their addresses stay the same
+    # across replays.
+    template_suffix = """
+with torch.profiler.profile(
+    activities=[
+        torch.profiler.ProfilerActivity.CPU,
+        torch.profiler.ProfilerActivity.CUDA,
+    ],
+    record_shapes=True,
+    on_trace_ready=trace_handler,
+) as prof:
+    for iter in range({warmup_iter} + {replay_iter}):
+        if iter == {warmup_iter}:
+            g = torch.cuda.CUDAGraph()
+            s = torch.cuda.Stream()
+            s.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(s):
+                run_ops()
+            torch.cuda.current_stream().wait_stream(s)
+            with torch.cuda.graph(g):
+                run_ops()
+            torch.cuda.synchronize()
+            start_ns = time.time_ns()
+        if iter < {warmup_iter}:
+            run_ops()
+        else:
+            g.replay()
+        torch.cuda.synchronize()
+        prof.step()
+    print("Execution finished!")
+    print("Avg execution time per iteration is {{}}ms".format((time.time_ns() - start_ns) / {replay_iter} / 1000000.0))
+
+"""
+    return template_suffix.format(warmup_iter=warmup_iter, replay_iter=replay_iter)